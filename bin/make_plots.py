@@ -1,11 +1,51 @@
 #!/usr/bin/env python3
 
-from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import gzip
+import io
 import numpy as np
 import os
 import pandas as pd
-import seaborn as sns
+import sys
+
+# Note: matplotlib and seaborn are only imported by the functions which
+# make plots, so that no time is spent loading them if there is nothing to plot
+
+# Parse CSVs with the Arrow reader, if it is installed
+# Note: each file is parsed on a single thread, and the files are
+# spread across worker processes instead (see read_files)
+try:
+    import pyarrow
+    pyarrow.set_cpu_count(1)
+    pyarrow.set_io_thread_count(1)
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+# Decompress gzip files with rapidgzip, if it is installed
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+# Define the complementary base changes
+COMPLEMENTARY_CHANGES = pd.Series({
+    "A -> T": "A:T -> T:A",
+    "T -> A": "A:T -> T:A",
+    "A -> C": "A:T -> C:G",
+    "T -> G": "A:T -> C:G",
+    "A -> G": "A:T -> G:C",
+    "T -> C": "A:T -> G:C",
+    "C -> A": "C:G -> A:T",
+    "G -> T": "C:G -> A:T",
+    "C -> T": "C:G -> T:A",
+    "G -> A": "C:G -> T:A",
+    "C -> G": "C:G -> G:C",
+    "G -> C": "C:G -> G:C",
+})
+BASE_PAIR_CHANGES = sorted(set(COMPLEMENTARY_CHANGES.values))
 
 # This folder contains a set of many CSV files with the following file name syntax
 # {specimen}.SSC.csv.gz
@@ -15,43 +55,138 @@ import seaborn as sns
 # {specimen}.snps_by_base.csv.gz
 # {specimen}.adducts_by_base.csv.gz
 
-# Generic function to read and merge the CSV files with the same extension
-def read_files(suffix, melt=False):
-    
-    # Populate a list
-    output = []
+# Counts in the SSC tables fit comfortably in 32 bits
+# Note: merged_len, n_adducts, and n_mutations are missing for any family
+# which was filtered out, so they are read as floats
+SSC_DTYPES = {
+    "nreads_pos": "int32",
+    "nreads_neg": "int32",
+    "rlen_fwd": "int32",
+    "merged_len": "float32",
+    "n_adducts": "float32",
+    "n_mutations": "float32",
+}
+
+# Suffixes of all of the files which are read in
+SUFFIXES = [
+    '.SSC.csv.gz',
+    '.unfiltered.SSC.details.csv.gz',
+    '.by_read_position.csv.gz',
+    '.snps_by_base.csv.gz',
+    '.adducts_by_base.csv.gz',
+]
+
+
+def list_by_suffix(suffixes):
+    """Scan the working directory once, grouping the files by suffix."""
+
+    buckets = {suffix: [] for suffix in suffixes}
+
+    with os.scandir('.') as it:
+        for entry in it:
+            for suffix in suffixes:
+
+                # A file may match more than one suffix
+                if entry.name.endswith(suffix):
+                    buckets[suffix].append(entry.name)
+
+    return buckets
+
+
+def open_gz(fp):
+    """Open a gzip-compressed file for reading with a large read buffer."""
+
+    # Use rapidgzip if it is available, with a single thread per file
+    if rapidgzip is not None:
+        return rapidgzip.open(fp, parallelization=1)
+
+    # Otherwise fall back to the standard library
+    return io.BufferedReader(gzip.open(fp), buffer_size=1 << 20)
+
+
+def _parse_csv(fp, **kwargs):
+    """Read a (gzip-compressed) CSV with the fastest available parser."""
+
+    # If the file is not compressed
+    if not fp.endswith(".gz"):
+
+        # Read it directly
+        return pd.read_csv(fp, engine=CSV_ENGINE, **kwargs)
+
+    # Otherwise, stream the decompressed data to the parser
+    with open_gz(fp) as handle:
+        return pd.read_csv(handle, engine=CSV_ENGINE, **kwargs)
+
+
+def read_csv(fp, usecols=None):
+    """Read a CSV, using the compact SSC dtypes for any of the selected columns."""
+
+    # If a subset of columns was not selected
+    if usecols is None:
+
+        # Let the parser infer all of the types
+        return _parse_csv(fp)
 
-    # Iterate over every file
-    for fp in os.listdir('.'):
+    # Parse any of the SSC count columns as 32-bit
+    dtype = {col: SSC_DTYPES[col] for col in usecols if col in SSC_DTYPES}
 
-        # Check for the file extension
-        if not fp.endswith(suffix):
-            continue
+    return _parse_csv(fp, usecols=usecols, dtype=dtype)
 
-        # Parse the specimen name
-        specimen = fp.replace(suffix, '')
 
-        # Read the file
-        df = pd.read_csv(fp)
+def _read_one(fp, melt=False, usecols=None, value_vars=None):
+    """Read a single CSV."""
 
-        # If the melt flag is set
-        if melt:
+    # Read the file, optionally only parsing a subset of columns
+    df = read_csv(fp, usecols=usecols)
 
-            # Then melt into long format
-            df = df.melt(id_vars=df.columns.values[0])
+    # If the melt flag is set
+    if melt:
 
-        # Add the specimen name
-        df = df.assign(specimen=specimen)
+        # Then melt into long format
+        df = df.melt(
+            id_vars=[df.columns[0]],
+            value_vars=value_vars,
+            var_name="variable",
+            value_name="value"
+        )
+
+    return df
+
+
+# Generic function to read and merge the CSV files with the same extension
+def read_files(suffix, melt=False, *, files=None, usecols=None, value_vars=None, executor=None):
 
-        # Add to the list
-        output.append(df)
+    # Get the list of files with the extension, unless provided
+    if files is None:
+        files = list_by_suffix([suffix])[suffix]
 
     # If there were no files with the extension
-    if len(output) == 0:
+    if len(files) == 0:
         return None
 
-    # Otherwise, join the DataFrames and return
-    return pd.concat(output).reset_index(drop=True)
+    # Decompress and parse each of the files,
+    # in parallel if a pool of worker processes was provided
+    mapper = map if executor is None else executor.map
+    output = list(mapper(partial(_read_one, melt=melt, usecols=usecols, value_vars=value_vars), files))
+
+    # Parse the specimen names
+    specimens = [fp.replace(suffix, '') for fp in files]
+    categories = sorted(specimens)
+    codes = {specimen: i for i, specimen in enumerate(categories)}
+
+    # Add the specimen name, sharing a single set of categories
+    output = [
+        df.assign(
+            specimen=pd.Categorical.from_codes(
+                np.full(df.shape[0], codes[specimen]),
+                categories=categories
+            )
+        )
+        for specimen, df in zip(specimens, output)
+    ]
+
+    # Join the DataFrames and return
+    return pd.concat(output, ignore_index=True)
 
 
 def plot_distribution(
@@ -64,45 +199,74 @@ def plot_distribution(
     ylabel=None,
     logx=False,
     logy=False,
+    ax=None,
 ):
-
-    # Try to make the plot
-    try:
-        
-        # Get the counts per bin
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    # Draw on the current axes, unless provided
+    if ax is None:
+        ax = plt.gca()
+
+    # For non-negative integer values
+    values = df[col_name]
+    if pd.api.types.is_integer_dtype(values) and values.min() >= 0:
+
+        # Get the counts per bin by counting each value directly
+        plot_df = []
+        for hue_key, hue_df in df.groupby(hue, observed=True):
+            counts = np.bincount(hue_df[col_name].to_numpy())
+            bins = counts.nonzero()[0]
+            plot_df.append(
+                pd.DataFrame({
+                    col_name: bins,
+                    "Count": counts[bins],
+                    hue: hue_key
+                })
+            )
         plot_df = pd.concat(
-            [
-                pd.DataFrame(
-                    {
-                        "Count": hue_df.groupby(col_name).apply(len)
-                    }
-                ).reset_index(
-                ).assign(
-                    **{hue: hue_key}
-                )
-                for hue_key, hue_df in df.groupby(hue)
-            ]
-        )
-        
-        sns.lineplot(
-            data=plot_df,
-            x=col_name,
-            y="Count",
-            hue=hue
+            plot_df,
+            ignore_index=True
+        ).astype(
+            # Keep the specimen categories, and their order
+            {hue: df[hue].dtype}
         )
-        annotate_and_save(
-            xlabel=xlabel,
-            ylabel=ylabel,
-            pdf=pdf,
-            title=title,
-            logx=logx,
-            logy=logy,
+
+    # Otherwise
+    else:
+
+        # Get the counts per bin
+        plot_df = df.groupby(
+            [hue, col_name],
+            observed=True,
+            sort=False
+        ).size(
+        ).reset_index(
+            name="Count"
         )
 
-    # If there is an index error, then the underlying data may not have
+    # If there is no data, then the underlying data may not have
     # had enough variation to plot the distribution
-    except IndexError:
+    if plot_df.empty:
         print(f"Could not make plot: x='{col_name}', hue='{hue}', title='{title}'")
+        return
+
+    sns.lineplot(
+        data=plot_df,
+        x=col_name,
+        y="Count",
+        hue=hue,
+        ax=ax
+    )
+    annotate_and_save(
+        ax,
+        xlabel=xlabel,
+        ylabel=ylabel,
+        pdf=pdf,
+        title=title,
+        logx=logx,
+        logy=logy,
+    )
 
 
 def plot_lines(
@@ -115,11 +279,19 @@ def plot_lines(
     xlabel=None,
     ylabel=None,
     alpha=0.5,
+    ax=None,
 ):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    # Draw on the current axes, unless provided
+    if ax is None:
+        ax = plt.gca()
+
     # Make the plot
-    sns.lineplot(data=df, x=x, y=y, hue=hue, alpha=alpha)
-    plt.legend(bbox_to_anchor=[1.1, 0.9])
-    annotate_and_save(xlabel=xlabel, ylabel=ylabel, pdf=pdf, title=title)
+    sns.lineplot(data=df, x=x, y=y, hue=hue, alpha=alpha, ax=ax)
+    ax.legend(bbox_to_anchor=[1.1, 0.9])
+    annotate_and_save(ax, xlabel=xlabel, ylabel=ylabel, pdf=pdf, title=title)
 
 
 def plot_bars(
@@ -128,44 +300,71 @@ def plot_bars(
     title=None,
     xlabel=None,
     ylabel=None,
+    ax=None,
 ):
+    import matplotlib.pyplot as plt
+
+    # Draw on the current axes, unless provided
+    if ax is None:
+        ax = plt.gca()
+
     # Make the plot - sorted by values
-    v.sort_values(ascending=False).plot(kind='barh')
-    annotate_and_save(xlabel=xlabel, ylabel=ylabel, pdf=pdf, title=title)
+    v.sort_values(ascending=False).plot(kind='barh', ax=ax)
+    annotate_and_save(ax, xlabel=xlabel, ylabel=ylabel, pdf=pdf, title=title)
 
 
-def annotate_and_save(xlabel=None, ylabel=None, pdf=None, title=None, logx=False, logy=False):
+def annotate_and_save(ax, xlabel=None, ylabel=None, pdf=None, title=None, logx=False, logy=False):
 
     # Log-transform x-axis
     if logx:
-        plt.xscale('log')
+        ax.set_xscale('log')
 
     # Log-transform y-axis
     if logy:
-        plt.yscale('log')
+        ax.set_yscale('log')
 
     # Set the title
     if title is not None:
-        plt.title(title)
+        ax.set_title(title)
 
     # Set the xlabel
     if xlabel is not None:
-        plt.xlabel(xlabel)
+        ax.set_xlabel(xlabel)
 
     # Set the ylabel
     if ylabel is not None:
-        plt.ylabel(ylabel)
+        ax.set_ylabel(ylabel)
 
     # Save to PDF
     if pdf is not None:
-        pdf.savefig(bbox_inches="tight")
+        pdf.savefig(ax.figure, bbox_inches="tight")
+
+    # Clear the plot so that the figure can be reused
+    clear_axes(ax)
+
 
-    # Close the plot
-    plt.close()
+def clear_axes(ax):
+    """Clear the axes for the next plot, removing any colorbar added to the figure."""
+
+    # Remove any other axes (e.g. the colorbar of a heatmap)
+    for other_ax in ax.figure.axes:
+        if other_ax is not ax:
+            other_ax.remove()
+
+    # Clear the plot, including any spines hidden by seaborn
+    ax.clear()
+    for spine in ax.spines.values():
+        spine.set_visible(True)
+
+    # Restore the original layout, in case space was taken by a colorbar
+    subplotspec = ax.get_subplotspec().get_topmost_subplotspec()
+    ax.set_subplotspec(subplotspec)
+    ax.set_position(subplotspec.get_position(ax.figure))
+    ax.set_anchor("C")
 
 
 # Specimen-level metrics
-def plot_specimen_summary(df, pdf):
+def plot_specimen_summary(df, pdf, ax=None):
 
     # If there is no data
     if df is None:
@@ -178,7 +377,8 @@ def plot_specimen_summary(df, pdf):
         df.snp_rate,
         pdf=pdf,
         title="SNP Rate",
-        xlabel="# of SNPs / # of sequenced bases"
+        xlabel="# of SNPs / # of sequenced bases",
+        ax=ax
     )
 
     # Plot the adduct rate per specimen
@@ -186,15 +386,22 @@ def plot_specimen_summary(df, pdf):
         df.adduct_rate,
         pdf=pdf,
         title="Adduct Rate",
-        xlabel="# of adducts / # of sequenced bases"
+        xlabel="# of adducts / # of sequenced bases",
+        ax=ax
     )
 
 # SSC summary metrics
 # {specimen}.SSC.csv.gz
-def plot_ssc_summary(pdf):
+def plot_ssc_summary(pdf, files=None, ax=None, executor=None):
 
     # Read the table
-    df = read_files('.SSC.csv.gz')
+    suffix = '.SSC.csv.gz'
+    df = read_files(
+        suffix,
+        files=None if files is None else files[suffix],
+        usecols=["rlen_fwd", "nreads_pos", "nreads_neg"],
+        executor=executor
+    )
 
     # If there is no data
     if df is None:
@@ -214,7 +421,8 @@ def plot_ssc_summary(pdf):
         "rlen_fwd",
         pdf=pdf,
         title="Read Length Distribution",
-        xlabel="Length of Sequence Reads"
+        xlabel="Length of Sequence Reads",
+        ax=ax
     )
 
     # Plot the number of reads per DSC
@@ -224,15 +432,21 @@ def plot_ssc_summary(pdf):
         pdf=pdf,
         title="DSC Sequencing Depth",
         xlabel="Number of reads per DSC",
-        logx=True
+        logx=True,
+        ax=ax
     )
     
 # Number of reads per family
 # {specimen}.unfiltered.SSC.details.csv.gz
-def plot_unfiltered_families(pdf, suffix='.unfiltered.SSC.details.csv.gz'):
+def plot_unfiltered_families(pdf, suffix='.unfiltered.SSC.details.csv.gz', files=None, ax=None, executor=None):
 
     # Read the table
-    df = read_files(suffix)
+    df = read_files(
+        suffix,
+        files=None if files is None else files[suffix],
+        usecols=["nreads_pos", "nreads_neg"],
+        executor=executor
+    )
 
     # If there is no data
     if df is None:
@@ -251,16 +465,23 @@ def plot_unfiltered_families(pdf, suffix='.unfiltered.SSC.details.csv.gz'):
         pdf=pdf,
         title="Unfiltered reads per family",
         xlabel="Number of reads per family",
-        logx=True
+        logx=True,
+        ax=ax
     )
 
 
 # Summary of mutations by read position
 # {specimen}.by_read_position.csv.gz
-def plot_read_position(pdf):
-    
+def plot_read_position(pdf, files=None, ax=None, executor=None):
+
     # Read the table
-    df = read_files('.by_read_position.csv.gz')
+    suffix = '.by_read_position.csv.gz'
+    df = read_files(
+        suffix,
+        files=None if files is None else files[suffix],
+        usecols=["pos", "snps", "adducts"],
+        executor=executor
+    )
 
     # If there is no data
     if df is None:
@@ -269,9 +490,11 @@ def plot_read_position(pdf):
         return
 
     # Calculate the proportion of SNPs and adducts
+    snps = df["snps"].to_numpy()
+    adducts = df["adducts"].to_numpy()
     df = df.assign(
-        snp_prop=df.snps / df.snps.sum(),
-        adduct_prop=df.adducts / df.adducts.sum(),
+        snp_prop=snps / snps.sum(),
+        adduct_prop=adducts / adducts.sum(),
     )
 
     plot_lines(
@@ -281,7 +504,8 @@ def plot_read_position(pdf):
         pdf=pdf,
         xlabel="Position in Read",
         ylabel="# of SNPs at position / total # of SNPs",
-        title="SNP Rate by Read Position"
+        title="SNP Rate by Read Position",
+        ax=ax
     )
 
     plot_lines(
@@ -291,7 +515,8 @@ def plot_read_position(pdf):
         pdf=pdf,
         xlabel="Position in Read",
         ylabel="# of adducts at position / total # of adducts",
-        title="Adduct Rate by Read Position"
+        title="Adduct Rate by Read Position",
+        ax=ax
     )
 
 
@@ -301,13 +526,28 @@ def plot_heatmap(
     csv_fp=None,
     pdf=None,
     title=None,
-    collapse_complementary=False
+    collapse_complementary=False,
+    files=None,
+    ax=None,
+    executor=None
 ):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    # Draw on the current axes, unless provided
+    if ax is None:
+        ax = plt.gca()
 
     print("Plotting files with the suffix: " + suffix)
     
     # Read the tables
-    df = read_files(suffix, melt=True)
+    df = read_files(
+        suffix,
+        melt=True,
+        files=None if files is None else files[suffix],
+        value_vars=list("ACGT"),
+        executor=executor
+    )
 
     # If there is no data
     if df is None:
@@ -315,20 +555,26 @@ def plot_heatmap(
         # Do not make any plot
         return
 
-    # Divide the value by the normalization factor by specimen
+    # Get the position of each specimen in the normalization factors,
+    # looking up each category once and then gathering by category code
+    codes = norm.index.get_indexer(
+        df.specimen.cat.categories
+    )[df.specimen.cat.codes.to_numpy()]
+
+    # Specimens without a normalization factor (code -1) get NaN
+    norm_values = np.append(norm.to_numpy(dtype=float), np.nan)
+
+    # Divide the value by the normalization factor by specimen, and
+    # format the base change as a string
     df = df.assign(
-        prop=df.value / df.specimen.apply(norm.get)
+        prop=df.value.to_numpy() / norm_values[codes],
+        base_change=df["base"].astype(str) + " -> " + df["variable"].astype(str)
     )
 
-    # Format the base change as a string
-    df = df.query(
-        "base != variable"
-    ).assign(
-        base_change=df.apply(
-            lambda r: f"{r['base']} -> {r['variable']}",
-            axis=1
-        )
-    ).pivot(
+    # Only keep the positions where the base changed
+    df = df[
+        df["base"].to_numpy() != df["variable"].to_numpy()
+    ].pivot(
         columns="specimen",
         index='base_change',
         values="prop"
@@ -353,52 +599,43 @@ def plot_heatmap(
     # Otherwise, if there is data to plot
 
     # Make a plot with the rate of counts per change
-    sns.heatmap(df, cmap="Blues")
-    plt.yticks(rotation=0)
-    plt.ylabel("Base Change")
-    plt.xlabel("")
+    sns.heatmap(df, cmap="Blues", ax=ax)
+    ax.tick_params(axis="y", labelrotation=0)
+    ax.set_ylabel("Base Change")
+    ax.set_xlabel("")
     if title is not None:
-        plt.title(title)
-    pdf.savefig(bbox_inches="tight")
-    plt.close()
+        ax.set_title(title)
+    pdf.savefig(ax.figure, bbox_inches="tight")
+    clear_axes(ax)
 
 
 def collapse_complementary_changes(df):
     """Combine all base changes which are on complementary strands."""
 
-    # Define the complementary base changes
-    complementary_changes = {
-        "A -> T": "A:T -> T:A",
-        "T -> A": "A:T -> T:A",
-        "A -> C": "A:T -> C:G",
-        "T -> G": "A:T -> C:G",
-        "A -> G": "A:T -> G:C",
-        "T -> C": "A:T -> G:C",
-        "C -> A": "C:G -> A:T",
-        "G -> T": "C:G -> A:T",
-        "C -> T": "C:G -> T:A",
-        "G -> A": "C:G -> T:A",
-        "C -> G": "C:G -> G:C",
-        "G -> C": "C:G -> G:C",
-    }
-
-    # Assign the complementary labels to the table,
+    # Label each base change by its base-pair change, using
+    # a fixed set of categories so that the groupby runs on integer codes
+    base_pair_change = pd.CategoricalIndex(
+        COMPLEMENTARY_CHANGES.reindex(df.index).values,
+        categories=BASE_PAIR_CHANGES,
+        name="base_pair_change"
+    )
+
     # Group by those labels, and
     # Compute the sum
-    return df.assign(
-        base_pair_change=list(map(complementary_changes.get, df.index.values))
-    ).groupby(
-        'base_pair_change'
+    return df.groupby(
+        base_pair_change,
+        observed=True
     ).sum()
 
-def read_specimen_summary(suffix='.SSC.csv.gz', exclude_suffix='.unfiltered.SSC.csv.gz'):
+def read_specimen_summary(suffix='.SSC.csv.gz', exclude_suffix='.unfiltered.SSC.csv.gz', files=None, executor=None):
     """Parse the SSC summary tables to get summary metrics."""
 
-    # Get the list of files with the suffix
+    # Get the list of files with the suffix, scanning the folder
+    # unless the files have already been listed
     fp_list = [
         fp
-        for fp in os.listdir('.')
-        if fp.endswith(suffix) and not fp.endswith(exclude_suffix)
+        for fp in (list_by_suffix([suffix])[suffix] if files is None else files[suffix])
+        if not fp.endswith(exclude_suffix)
     ]
 
     # If there are no files with the suffix
@@ -409,77 +646,150 @@ def read_specimen_summary(suffix='.SSC.csv.gz', exclude_suffix='.unfiltered.SSC.
 
     # Otherwise
 
-    # Join together data from all of those files
-    df = pd.DataFrame(
-        [
-            parse_specimen_summary(fp, fp[:-(len(suffix))])
-            for fp in fp_list
-        ]
-    ).set_index('specimen')
+    # Allocate an array for each of the summary metrics
+    n = len(fp_list)
+    specimens = np.empty(n, dtype=object)
+    dsc = np.empty(n, dtype=np.int64)
+    bases = np.empty(n, dtype=np.int64)
+    adducts = np.empty(n, dtype=np.int64)
+    snps = np.empty(n, dtype=np.int64)
+
+    # Fill in data from all of those files,
+    # reading them in parallel if a pool of worker processes was provided
+    mapper = map if executor is None else executor.map
+    for i, summary in enumerate(mapper(
+        parse_specimen_summary,
+        fp_list,
+        [fp[:-(len(suffix))] for fp in fp_list]
+    )):
+        specimens[i] = summary["specimen"]
+        dsc[i] = summary["dsc"]
+        bases[i] = summary["bases"]
+        adducts[i] = summary["adducts"]
+        snps[i] = summary["snps"]
 
     # Calculate the rate of SNPs and adducts
-    df = df.assign(
-        adduct_rate=df.adducts / df.bases,
-        snp_rate=df.snps / df.bases,
+    return pd.DataFrame(
+        {
+            "dsc": dsc,
+            "bases": bases,
+            "adducts": adducts,
+            "snps": snps,
+            "adduct_rate": adducts / bases,
+            "snp_rate": snps / bases,
+        },
+        index=pd.Index(specimens, name="specimen")
+    )
+
+def sum_summary_columns(merged_len, n_adducts, n_mutations):
+    """Sum the three summary columns, skipping missing values."""
+
+    return (
+        np.nansum(merged_len, dtype=np.float64),
+        np.nansum(n_adducts, dtype=np.float64),
+        np.nansum(n_mutations, dtype=np.float64)
     )
 
-    return df
 
 def parse_specimen_summary(fp, specimen):
     """Get specimen summary metrics from a single SSC.csv.gz file."""
-    df = pd.read_csv(fp)
+    df = read_csv(fp, usecols=["merged_len", "n_adducts", "n_mutations"])
+
+    bases, adducts, snps = sum_summary_columns(
+        df.merged_len.to_numpy(),
+        df.n_adducts.to_numpy(),
+        df.n_mutations.to_numpy()
+    )
 
     return dict(
         specimen=specimen,
-        dsc=df.shape[0],
-        bases=df.merged_len.sum(),
-        adducts=df.n_adducts.sum(),
-        snps=df.n_mutations.sum()
+        dsc=len(df),
+        bases=bases,
+        adducts=adducts,
+        snps=snps
     )
 
-# Get the total number of sequenced bases per specimen
-specimen_summary = read_specimen_summary()
+if __name__ == "__main__":
 
-# If there is data
-if specimen_summary is not None:
+    # The number of CPUs allocated to this task (1 if not specified)
+    cpus = int(sys.argv[1]) if len(sys.argv) > 1 else 1
 
-    # Save the specimen summary
-    specimen_summary.to_csv("summary.csv")
+    # Read the files in a single pool of worker processes, if more than one CPU is available
+    # The pool is shut down on the way out, including when there are no inputs
+    with (
+        ProcessPoolExecutor(max_workers=cpus) if cpus > 1 else nullcontext()
+    ) as executor:
 
-# Open up a PDF for plotting
-with PdfPages("report.pdf") as pdf:
+        # Scan the folder for all of the input files
+        files = list_by_suffix(SUFFIXES)
 
-    # Plot the number of reads per family
-    plot_unfiltered_families(pdf)
+        # Get the total number of sequenced bases per specimen
+        specimen_summary = read_specimen_summary(files=files, executor=executor)
 
-    # Plot a summary of SSC metrics
-    plot_ssc_summary(pdf)
+        # If there is data
+        if specimen_summary is not None:
 
-    # Plot a summary of each specimen
-    plot_specimen_summary(specimen_summary, pdf)
+            # Save the specimen summary
+            specimen_summary.to_csv("summary.csv")
 
-    # Only plot heatmaps if the specimen summary is available
-    if specimen_summary is not None:
-    
-        # Summary of mutations by base -> base
-        # {specimen}.snps_by_base.csv.gz
-        plot_heatmap(
-            suffix=".snps_by_base.csv.gz",
-            csv_fp="snps_by_base.csv",
-            norm=specimen_summary.bases,
-            pdf=pdf,
-            title="SNPs by Base",
-            collapse_complementary=True
-        )
-        # Summary of adducts by base -> base
-        # {specimen}.adducts_by_base.csv.gz
-        plot_heatmap(
-            suffix=".adducts_by_base.csv.gz",
-            csv_fp="adducts_by_base.csv",
-            norm=specimen_summary.bases,
-            pdf=pdf,
-            title="Adducts by Base",
-            collapse_complementary=False
-        )
+        # If there are no input files at all
+        elif not any(files.values()):
+
+            # Stop before loading any of the plotting libraries
+            print("No input files found, skipping plots")
+            sys.exit(0)
+
+        # Use the non-interactive backend, skipping any GUI backend probing
+        import matplotlib
+        matplotlib.use("Agg")
+        from matplotlib.backends.backend_pdf import PdfPages
+        import matplotlib.pyplot as plt
+
+        # Make a single figure, which is reused for every page
+        fig, ax = plt.subplots()
+
+        # Open up a PDF for plotting
+        with PdfPages("report.pdf") as pdf:
+
+            # Plot the number of reads per family
+            plot_unfiltered_families(pdf, files=files, ax=ax, executor=executor)
+
+            # Plot a summary of SSC metrics
+            plot_ssc_summary(pdf, files=files, ax=ax, executor=executor)
+
+            # Plot a summary of each specimen
+            plot_specimen_summary(specimen_summary, pdf, ax=ax)
+
+            # Only plot heatmaps if the specimen summary is available
+            if specimen_summary is not None:
+
+                # Summary of mutations by base -> base
+                # {specimen}.snps_by_base.csv.gz
+                plot_heatmap(
+                    suffix=".snps_by_base.csv.gz",
+                    csv_fp="snps_by_base.csv",
+                    norm=specimen_summary.bases,
+                    pdf=pdf,
+                    title="SNPs by Base",
+                    collapse_complementary=True,
+                    files=files,
+                    ax=ax,
+                    executor=executor
+                )
+                # Summary of adducts by base -> base
+                # {specimen}.adducts_by_base.csv.gz
+                plot_heatmap(
+                    suffix=".adducts_by_base.csv.gz",
+                    csv_fp="adducts_by_base.csv",
+                    norm=specimen_summary.bases,
+                    pdf=pdf,
+                    title="Adducts by Base",
+                    collapse_complementary=False,
+                    files=files,
+                    ax=ax,
+                    executor=executor
+                )
+
+            plot_read_position(pdf, files=files, ax=ax, executor=executor)
 
-    plot_read_position(pdf)
+        plt.close(fig)
@@ -13,14 +13,23 @@ Parse the SSC data in order to:
 """
 
 from collections import defaultdict
+from contextlib import ExitStack
 import gzip
+from itertools import islice
 import json
 import logging
+import numpy as np
 import os
 import pandas as pd
 import pysam
 import sys
 
+# Serialize JSON with orjson, if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Set up logging
 logFormatter = logging.Formatter(
     '%(asctime)s %(levelname)-8s [parse_ssc] %(message)s'
@@ -52,47 +61,102 @@ assert os.path.exists(input_pos_bam)
 input_neg_bam = "NEG.SSC.bam"
 assert os.path.exists(input_neg_bam)
 
+# The number of CPUs allocated to this task (1 if not specified),
+# used for the worker processes and for htslib to compress and decompress BAM files
+THREADS = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+print(f"threads = {THREADS}")
+
+
+# Complementary bases
+COMPLEMENT = dict(
+    A='T',
+    T='A',
+    C='G',
+    G='C'
+)
+
+
+# Lookup table which is 1 for each of the bases A, T, C, and G, indexed by byte
+# Any other character (N, IUPAC codes, etc.) is not used to call variants or adducts
+ATCG_MASK = bytes(1 if c in b"ATCG" else 0 for c in range(256))
+ATCG_ARRAY = np.frombuffer(ATCG_MASK, dtype=np.uint8).astype(np.bool_)
+
+# Position of the data for each strand and orientation in the list of reads per family
+READ_SLOTS = dict(
+    pos=dict(fwd=0, rev=1),
+    neg=dict(fwd=2, rev=3)
+)
+
+# Order of the bases in the tables of base changes
+BASES = ['A', 'T', 'C', 'G']
+BASE_INDEX = {base: i for i, base in enumerate(BASES)}
+
+
+def dumps_json(obj):
+    """Serialize an object as JSON bytes, converting any integer keys to strings."""
+
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        return json.dumps(obj).encode()
+
+
+# Lookup table with the IUPAC code for every pair of bytes,
+# indexed by (base1 << 8) | base2, and N for any other character
+# https://www.bioinformatics.org/sms/iupac.html
+IUPAC_TABLE = np.full(1 << 16, ord("N"), dtype=np.uint8)
+for base1, codes in dict(
+    A=dict(A="A", T="W", C="M", G="R"),
+    T=dict(A="W", T="T", C="Y", G="K"),
+    C=dict(A="M", T="Y", C="C", G="S"),
+    G=dict(A="R", T="K", C="S", G="G"),
+).items():
+    for base2, code in codes.items():
+        IUPAC_TABLE[(ord(base1) << 8) | ord(base2)] = ord(code)
 
-def complement(base):
-    """Return the complementary base."""
-
-    return dict(
-        A='T',
-        T='A',
-        C='G',
-        G='C'
-    )[base]
-
-
-def iupac(base1, base2):
-    """https://www.bioinformatics.org/sms/iupac.html"""
-
-    return dict(
-        A=dict(
-            A="A",
-            T="W",
-            C="M",
-            G="R",
-        ),
-        T=dict(
-            A="W",
-            T="T",
-            C="Y",
-            G="K",
-        ),
-        C=dict(
-            A="M",
-            T="Y",
-            C="C",
-            G="S",
-        ),
-        G=dict(
-            A="R",
-            T="K",
-            C="S",
-            G="G",
-        ),
-    ).get(base1, {}).get(base2, "N")
+
+# Classes of mismatches between the two strands and the reference
+VARIANT = 1               # Both strands match each other, but not the reference
+VARIANT_AND_ADDUCT = 2    # Both strands differ from each other and the reference
+POS_ADDUCT = 3            # Only the positive strand differs from the reference
+NEG_ADDUCT = 4            # Only the negative strand differs from the reference
+
+
+def merge_strands_kernel(pos_arr, neg_arr, ref_arr, allowed, span):
+    """
+    Compare both strands against the reference at every position, returning:
+    - the number of positions sequenced on both strands
+    - the number of those positions by distance from the nearest end (readpos)
+    - the index of each mismatched position
+    - the class of each mismatched position (VARIANT, VARIANT_AND_ADDUCT, etc.)
+    `allowed` is a 256-element lookup table which is True for the allowed bases,
+    and `span` is the distance between the start and end of the DSC.
+    """
+
+    # Positions where both strands were sequenced
+    sequenced = allowed[pos_arr] & allowed[neg_arr]
+
+    # Get the shortest distance to the either end
+    offset = np.arange(pos_arr.shape[0])
+    readpos = np.minimum(offset, span - offset) + 1
+    nreads = np.bincount(readpos[sequenced], minlength=pos_arr.shape[0] + 1)
+
+    # Positions where the reference is known
+    known = sequenced & allowed[ref_arr]
+    pos_mismatch = known & (pos_arr != ref_arr)
+    neg_mismatch = known & (neg_arr != ref_arr)
+
+    # Classify each mismatch
+    mismatch_class = np.zeros(pos_arr.shape[0], dtype=np.uint8)
+    both_mismatch = pos_mismatch & neg_mismatch
+    mismatch_class[both_mismatch & (pos_arr == neg_arr)] = VARIANT
+    mismatch_class[both_mismatch & (pos_arr != neg_arr)] = VARIANT_AND_ADDUCT
+    mismatch_class[pos_mismatch & ~neg_mismatch] = POS_ADDUCT
+    mismatch_class[neg_mismatch & ~pos_mismatch] = NEG_ADDUCT
+
+    mismatch_ix = np.flatnonzero(mismatch_class)
+
+    return int(sequenced.sum()), nreads, mismatch_ix, mismatch_class[mismatch_ix]
 
 
 class ParseSSC:
@@ -108,21 +172,17 @@ class ParseSSC:
         self.filter_max = filter_max
 
         # Keep track of the reference sequence
-        # Key by ref_name and position
-        self.refseq = defaultdict(lambda: dict())
+        # Key by ref_name, with one byte per position (0 if not yet observed)
+        # Note: each buffer is zero-filled up front and fully resident (e.g. ~250 MB
+        # for chr1), so it is only created once a read is aligned to that contig
+        self.refseq = dict()
+        with pysam.AlignmentFile(input_pos_bam, "rb", threads=THREADS) as bam:
+            self.ref_lengths = dict(zip(bam.references, bam.lengths))
 
         # Record information from each read
-        self.read_info = defaultdict(
-            # Keep track of data from the positive and negative strands,
-            # for the forward and reverse reads
-            lambda: {
-                strand: {
-                    orient: dict()
-                    for orient in ["fwd", "rev"]
-                }
-                for strand in ["pos", "neg"]
-            }
-        )
+        # Keyed by family ID, with a list of the data from the positive and
+        # negative strands, for the forward and reverse reads (see READ_SLOTS)
+        self.read_info = dict()
 
         # Keep information about the position of variants
         # relative to the read start
@@ -131,10 +191,16 @@ class ParseSSC:
             for key in ['adducts', 'variants', 'nreads']
         }
 
-        # Parse the information from the positive strand
-        self.parse_bam(fp=input_pos_bam, strand="pos")
-        # Parse the information from the negative strand
-        self.parse_bam(fp=input_neg_bam, strand="neg")
+        # Parse the information from the positive and negative strands,
+        # filling in the reference sequence
+        for fp, strand in [(input_pos_bam, "pos"), (input_neg_bam, "neg")]:
+            for family_id, family_reads in self.parse_bam(fp=fp, strand=strand).items():
+                rec = self.read_info.get(family_id)
+                if rec is None:
+                    self.read_info[family_id] = family_reads
+                else:
+                    for slot in READ_SLOTS[strand].values():
+                        rec[slot] = family_reads[slot]
 
         # Merge the information from the forward and reverse
         # reads of each SSC
@@ -143,30 +209,66 @@ class ParseSSC:
         # Merge the information from both strands
         self.merge_pos_neg_strands()
 
+        # The reference sequence is no longer needed
+        self.refseq = None
+
+        # Get the total number of variants (and adducts) for each family,
+        # with the families sorted from lowest to highest
+        levels = np.fromiter(
+            (dsc[self.filter_on] for dsc in self.dsc_info.values()),
+            dtype=np.int64,
+            count=len(self.dsc_info)
+        )
+        family_ids = np.array(list(self.dsc_info), dtype=object)
+        order = np.argsort(levels, kind="stable")
+        levels = levels[order]
+        family_ids = family_ids[order]
+
         # Write out the total information without filtering
-        self.write_output(folder="all", max_vars=None)
+        folders = {"all": None}
 
         # For each of the unique values of the total number of variants and adducts per read
-        for max_vars in list(set([
-            self.dsc_info[family_id][self.filter_on]
-            for family_id in self.dsc_info
-        ])):
+        for max_vars in np.unique(levels).tolist():
 
             # Don't write outputs for anything over filter_max
             if max_vars > self.filter_max:
-                continue
+                break
 
             # Write out the total information, filtering to that maximum number
-            self.write_output(folder=f"max_variants_{max_vars}", max_vars=max_vars)
+            folders[f"max_variants_{max_vars}"] = max_vars
+
+        # Flatten the information needed for the summary tables
+        self.format_summary_records()
+
+        # Write out the tables for each folder
+        for folder, max_vars in folders.items():
+
+            # Keep the families which do not exceed the filter,
+            # which are at the start of the sorted list
+            if max_vars is None:
+                nkeep = len(family_ids)
+            else:
+                nkeep = np.searchsorted(levels, max_vars, side="right")
+
+            self.write_output(folder=folder, keep_families=set(family_ids[:nkeep].tolist()))
+
+        # Write out the DSC and SSC BAMs for every folder in a single pass
+        self.write_bams(folders)
 
     def parse_bam(self, fp=None, strand=None):
-        """Parse all of the data from a single BAM."""
+        """
+        Parse all of the data from a single BAM, returning a dict
+        keyed by family ID, with the reads in the slots for this strand.
+        """
 
         assert strand in ["pos", "neg"], f"Unrecognized strand '{strand}'"
 
+        strand_reads = dict()
+        slots = READ_SLOTS[strand]
+
         # Open the input BAM file for reading
         logger.info(f"Reading from {fp}")
-        with pysam.AlignmentFile(fp, "rb") as bam:
+        with pysam.AlignmentFile(fp, "rb", threads=THREADS) as bam:
 
             # For each of the reads on the positive strand    
             for read in bam:
@@ -175,13 +277,12 @@ class ParseSSC:
                 family_id, orientation, read_stats = self.parse_read(read)
 
                 # Add to the dataset
-                self.read_info[
-                    family_id
-                ][
-                    strand
-                ][
-                    orientation
-                ] = read_stats
+                rec = strand_reads.get(family_id)
+                if rec is None:
+                    rec = strand_reads[family_id] = [None, None, None, None]
+                rec[slots[orientation]] = read_stats
+
+        return strand_reads
 
     def parse_read(self, read):
         """
@@ -196,27 +297,37 @@ class ParseSSC:
         
         # Orientation
         orient = 'rev' if read.is_reverse else 'fwd'
+
+        # Get the position of the read once
+        ref_name = read.reference_name
+        ref_start = read.reference_start
+
+        # Get the query and reference sequences once, as uppercase bytes
+        qseq = read.query_sequence.upper().encode()
+        rseq = read.get_reference_sequence().upper().encode()
         
         # Details for the position and variants in the read
         read_details = dict(
             # Chromosome / contig name
-            ref_name = read.reference_name,
+            ref_name = ref_name,
             # Leftmost position
-            start = read.reference_start,
+            start = ref_start,
             # Rightmost position
             end = read.reference_end,
             # Variants
-            variants = self.parse_variants(read)
+            variants = self.parse_variants(read, ref_name, ref_start, rseq, qseq)
         )
 
         # Tuple, Family ID, orientation, and a dict with position and variants
         return family_id, orient, read_details
 
-    def parse_variants(self, read, allowed_nucs=set(['A', 'T', 'C', 'G'])):
+    def parse_variants(self, read, ref_name, ref_start, rseq, qseq):
         """
         For any position in which the read differs from the reference,
         include the reference position and the variant base in a dict.
-        Skip any position which does not contain one of the `allowed_nucs`.
+        The reference and query sequences (`rseq`, `qseq`) are uppercase bytes,
+        with the reference sequence starting at `ref_start` on `ref_name`.
+        Skip any position which does not contain one of A, T, C, or G (see ATCG_MASK).
         Lowercase bases in the reference will automatically be transformed
         into uppercase. Based on this behavior, soft-masked bases will be
         included in all of the mutational positions.
@@ -225,30 +336,24 @@ class ParseSSC:
         # Encode the as a dict of positions where the read does not match the reference
         variants = dict()
 
-        # Get the reference sequence
-        rseq = read.get_reference_sequence()
+        # Record the observed reference bases for this contig
+        ref_bases = self.refseq.get(ref_name)
+        if ref_bases is None:
+            ref_bases = self.refseq[ref_name] = bytearray(self.ref_lengths[ref_name])
 
-        # get_aligned_pairs() returns a tuple of positions
-        for qpos, rpos in read.get_aligned_pairs():
-
-            # If there is an indel
-            if rpos is None or qpos is None:
-                
-                # Skip it
-                continue
-
-            rpos = int(rpos)
-            qpos = int(qpos)
+        # get_aligned_pairs() returns a tuple of positions,
+        # only including the aligned positions (skipping any indels)
+        for qpos, rpos in read.get_aligned_pairs(matches_only=True):
 
             # Get the aligned and reference bases
-            qbase = read.query_sequence[qpos].upper()
-            rbase = rseq[rpos - read.reference_start].upper()
+            qbase = qseq[qpos]
+            rbase = rseq[rpos - ref_start]
 
             # Record the reference position
-            self.refseq[read.reference_name][rpos] = rbase
+            ref_bases[rpos] = rbase
 
             # If the reference base has been masked
-            if rbase not in allowed_nucs or qbase not in allowed_nucs:
+            if not ATCG_MASK[rbase] or not ATCG_MASK[qbase]:
 
                 # Skip it
                 continue
@@ -260,7 +365,7 @@ class ParseSSC:
                 continue
 
             # Otherwise, record the query base in the output
-            variants[rpos] = qbase
+            variants[rpos] = chr(qbase)
 
         return variants
 
@@ -298,23 +403,30 @@ class ParseSSC:
         for family_id, family_reads in self.read_info.items():
 
             # For each strand
-            for strand, strand_reads in family_reads.items():
+            for strand, slots in READ_SLOTS.items():
 
                 # Merge a single pair of forward and reverse reads
-                self.merge_read_pair(family_id, strand, strand_reads)
+                self.merge_read_pair(
+                    family_id,
+                    strand,
+                    family_reads[slots["fwd"]],
+                    family_reads[slots["rev"]]
+                )
 
-    def merge_read_pair(self, family_id, strand, strand_reads):
+    def merge_read_pair(self, family_id, strand, fwd, rev):
         """Merge the forward and reverse reads for a single strand of a single family."""
 
+        strand_reads = dict(fwd=fwd, rev=rev)
+
         # If we don't have forward and reverse reads
-        if "fwd" not in strand_reads or "rev" not in strand_reads:
+        if fwd is None or rev is None:
             logger.info("Unexpected - didn't find forward and reverse")
             logger.info(json.dumps(strand_reads))
             return
 
         # If the forward and reverse strands are on different chromosomes
-        ref_name = strand_reads["fwd"]["ref_name"]
-        if ref_name != strand_reads["rev"].get("ref_name"):
+        ref_name = fwd["ref_name"]
+        if ref_name != rev["ref_name"]:
 
             # Log and stop
             logger.info(f"Unexpected -- reads are on different references ({family_id} - {strand})")
@@ -322,7 +434,7 @@ class ParseSSC:
             return
 
         # If the forward read is not 5' to the reverse read
-        if strand_reads["fwd"]["start"] >= strand_reads["rev"]["end"]:
+        if fwd["start"] >= rev["end"]:
 
             # Log and stop
             logger.info(f"Unexpected -- reads are not oriented inwards ({family_id} - {strand})")
@@ -331,18 +443,17 @@ class ParseSSC:
 
         # Record the positional information
         self.ssc_info[family_id][strand]["ref_name"] = ref_name
-        self.ssc_info[family_id][strand]["start"] = strand_reads["fwd"]["start"]
-        self.ssc_info[family_id][strand]["end"] = strand_reads["rev"]["end"]
+        self.ssc_info[family_id][strand]["start"] = fwd["start"]
+        self.ssc_info[family_id][strand]["end"] = rev["end"]
 
-        # Get the set of positions covered by the read pair
-        covered_bases = dict()
+        # Get the end of the forward read and the start of the reverse read,
+        # which bound any gap between them
+        fwd_end = fwd["end"]
+        rev_start = rev["start"]
 
         # Combine the variants from the forward and reverse reads
         for fwd_rev, strand_info in strand_reads.items():
 
-            # Add the bases covered by this read
-            covered_bases[fwd_rev] = set(range(strand_info["start"], strand_info["end"]+1))
-
             # Iterate over the variant bases
             for refpos, variant_base in strand_info["variants"].items():
 
@@ -356,44 +467,27 @@ class ParseSSC:
                 self.ssc_info[family_id][strand]["variants"][refpos] = dict(
                     readpos=readpos,
                     var=variant_base,
-                    ref=self.refseq[ref_name][refpos]
+                    ref=chr(self.refseq[ref_name][refpos])
                 )
 
-        # Get the combined set of covered positions
-        covered_bases = covered_bases["fwd"] | covered_bases["rev"]
-
-        # Build the consensus sequence
-        cons = []
-
-        # Iterate over each position
-        for pos in range(
-            self.ssc_info[family_id][strand]["start"],
-            self.ssc_info[family_id][strand]["end"] + 1
-        ):
-
-            # If the position is covered
-            if pos in covered_bases:
-
-                # If the position is a variant, add it
-                # otherwise add the reference
-                cons.append(
-                    self.ssc_info[family_id][strand]["variants"].get(
-                        pos,
-                        {}
-                    ).get(
-                        "var",
-                        self.refseq[ref_name].get(pos, "N")
-                    )
-                )
+        # Build the consensus sequence, starting from the reference (N if not observed)
+        start = self.ssc_info[family_id][strand]["start"]
+        end = self.ssc_info[family_id][strand]["end"]
+        cons = bytearray(self.refseq[ref_name][start:end + 1]).replace(b"\0", b"N")
 
-            # If the position is not covered
-            else:
+        # Add N for any positions between the reads which are not covered by either
+        gap_start = max(fwd_end + 1, start)
+        gap_end = min(rev_start, end + 1)
+        if gap_start < gap_end:
+            cons[gap_start - start:gap_end - start] = b"N" * (gap_end - gap_start)
 
-                # Add N
-                cons.append("N")
+        # Add each of the variants
+        for pos, variant in self.ssc_info[family_id][strand]["variants"].items():
+            if start <= pos <= end:
+                cons[pos - start] = ord(variant["var"])
 
-        # Concatenate and save the consensus sequence
-        self.ssc_info[family_id][strand]["cons"] = "".join(cons)
+        # Save the consensus sequence
+        self.ssc_info[family_id][strand]["cons"] = cons.decode()
 
     def merge_pos_neg_strands(self):
         """Merge the information for the positive and negative strands per family."""
@@ -439,10 +533,17 @@ class ParseSSC:
         # For each family
         for family_id, family_strands in self.ssc_info.items():
 
+            # If either strand could not be merged (e.g. a read was missing)
+            if family_strands["pos"]["start"] is None or family_strands["neg"]["start"] is None:
+
+                # Log and skip the family
+                logger.info(f"Unexpected -- family does not have both strands ({family_id})")
+                continue
+
             # Merge the strands
             self.merge_strands(family_id, family_strands)
 
-    def merge_strands(self, family_id, family_strands, allowed_nucs=set(['A', 'T', 'C', 'G'])):
+    def merge_strands(self, family_id, family_strands):
         """Merge the information for both strands."""
 
         # Get the inner positions for the start and stop
@@ -460,50 +561,53 @@ class ParseSSC:
             for strand, strand_dict in family_strands.items()
         }
 
-        # Build a list of the double-stranded consensus sequence
-        cons_list = []
-
         # Get the reference name
         ref_name = family_strands["pos"]["ref_name"]
         self.dsc_info[family_id]["ref_name"] = ref_name
 
-        # Iterate over the sequence at each position
-        for refpos, pos_base, neg_base in zip(range(start_pos, end_pos + 1), strand_cons["pos"], strand_cons["neg"]):
+        # Number of positions covered by the double-stranded consensus
+        dsc_len = max(end_pos - start_pos + 1, 0)
+        pos_cons = strand_cons["pos"][:dsc_len]
+        neg_cons = strand_cons["neg"][:dsc_len]
+        npos = min(len(pos_cons), len(neg_cons))
+
+        # Get the reference sequence across the same positions,
+        # with N for any position which was not observed
+        ref_cons = bytes(
+            self.refseq[ref_name][start_pos:start_pos + npos]
+        ).replace(b"\0", b"N").decode()
+
+        # Encode each sequence as an array of bytes
+        pos_arr = np.frombuffer(pos_cons[:npos].encode(), dtype=np.uint8)
+        neg_arr = np.frombuffer(neg_cons[:npos].encode(), dtype=np.uint8)
+        ref_arr = np.frombuffer(ref_cons.encode(), dtype=np.uint8)
+
+        # Compare both strands and the reference at every position
+        nbases, nreads, mismatch_ix, mismatch_class = merge_strands_kernel(
+            pos_arr, neg_arr, ref_arr, ATCG_ARRAY, end_pos - start_pos
+        )
 
-            # If either strand was not sequenced
-            if pos_base not in allowed_nucs or neg_base not in allowed_nucs:
+        # Increment the counter with the number of bases sequenced
+        self.dsc_info[family_id]["nbases"] += int(nbases)
+        for readpos in np.flatnonzero(nreads):
+            self.base_positions["nreads"][int(readpos)] += int(nreads[readpos])
 
-                # Add an N to the consensus
-                cons_list.append("N")
+        # Iterate over just the mismatched positions
+        for ix, mismatch in zip(mismatch_ix.tolist(), mismatch_class.tolist()):
 
-                # Move on
-                continue
-
-            # Get the reference base at this position
-            refbase = self.refseq[ref_name][refpos]
+            refpos = start_pos + ix
+            pos_base = pos_cons[ix]
+            neg_base = neg_cons[ix]
+            refbase = ref_cons[ix]
 
             # Get the shortest distance to the either end
             readpos = min(refpos - start_pos, end_pos - refpos) + 1
-            assert readpos > 0, (refpos, start_pos, end_pos)
-
-            # Increment the counter with the number of bases sequenced
-            self.dsc_info[family_id]["nbases"] += 1
-            self.base_positions["nreads"][readpos] += 1
-
-            # Add the merged base to the consensus
-            cons_list.append(iupac(pos_base, neg_base))
-
-            # If the reference is not known at this position
-            if refbase not in allowed_nucs:
-
-                # Move on
-                continue
 
             # If both bases are mismatched
-            if pos_base != refbase and neg_base != refbase:
+            if mismatch in (VARIANT, VARIANT_AND_ADDUCT):
 
                 # If they are the same
-                if pos_base == neg_base:
+                if mismatch == VARIANT:
 
                     # It is a variant
                     self.dsc_info[family_id]["variants"][refpos] = dict(
@@ -525,8 +629,8 @@ class ParseSSC:
                     # And the negative strand is the adduct
                     self.dsc_info[family_id]["adducts"][refpos] = dict(
                         strand="neg",
-                        var=complement(neg_base),
-                        ref=complement(refbase)
+                        var=COMPLEMENT[neg_base],
+                        ref=COMPLEMENT[refbase]
                     )
                     self.base_positions["adducts"][readpos] += 1
 
@@ -537,7 +641,7 @@ class ParseSSC:
                 self.dsc_info[family_id]["total_variants"] += 1
 
             # If only the positive strand is mismatched
-            elif pos_base != refbase:
+            elif mismatch == POS_ADDUCT:
 
                 # The positive strand is the adduct
                 self.dsc_info[family_id]["adducts"][refpos] = dict(
@@ -551,23 +655,27 @@ class ParseSSC:
                 self.dsc_info[family_id]["total_variants_and_adducts"] += 1
 
             # If only the negative strand is mismatched
-            elif neg_base != refbase:
+            else:
 
                 # The negative strand is the adduct
                 self.dsc_info[family_id]["adducts"][refpos] = dict(
                     strand="neg",
-                    var=complement(neg_base),
-                    ref=complement(refbase)
+                    var=COMPLEMENT[neg_base],
+                    ref=COMPLEMENT[refbase]
                 )
                 self.base_positions["adducts"][readpos] += 1
 
                 # Increment the total number of variants and adducts
                 self.dsc_info[family_id]["total_variants_and_adducts"] += 1
 
-        self.dsc_info[family_id]["cons"] = "".join(cons_list)
+        # Build the double-stranded consensus sequence, merging
+        # the bases from both strands with the IUPAC lookup table
+        self.dsc_info[family_id]["cons"] = IUPAC_TABLE[
+            (pos_arr.astype(np.uint16) << 8) | neg_arr
+        ].tobytes().decode()
 
-    def write_output(self, folder=None, max_vars=None):
-        """Write all outputs to a folder, optionally filtering by total number of variants."""
+    def write_output(self, folder=None, keep_families=None):
+        """Write all of the tables to a folder, for the set of families in `keep_families`."""
 
         # If the folder doesn't exist
         if not os.path.exists(folder):
@@ -576,13 +684,6 @@ class ParseSSC:
             logger.info(f"Creating folder {folder}")
             os.mkdir(folder)
 
-        # Make a set of all families which do not exceed the filter
-        keep_families = set([
-            family_id
-            for family_id, dsc in self.dsc_info.items()
-            if max_vars is None or dsc[self.filter_on] <= max_vars
-        ])
-
         # Save the adduct information as GTF
         self.write_adducts_gtf(folder=folder, keep_families=keep_families)
 
@@ -627,30 +728,27 @@ class ParseSSC:
         logger.info(f"Output path: {base_positions_output}")
 
         # Format the data by read position as a DataFrame
-        base_positions = pd.DataFrame(self.base_positions).fillna(0).applymap(int)
+        base_positions = pd.DataFrame(self.base_positions).fillna(0).astype(np.int64)
         base_positions.to_csv(base_positions_output, index_label="pos")
 
-        # Write out the filtered DSC and SSC as BAM
-        for info, prefix, flag in [
-            (self.dsc_info, "DSC", 99),
-            ({family_id: ssc["pos"] for family_id, ssc in self.ssc_info.items()}, "SSC.POS", 99),
-            ({family_id: ssc["neg"] for family_id, ssc in self.ssc_info.items()}, "SSC.NEG", 83)
-        ]:
-            self.write_bam(
-                info,
-                fp=os.path.join(folder, f"{folder}.{prefix}.bam"),
-                keep_families=keep_families,
-                flag=flag
-            )
-
-    def write_bam(self, info, keep_families=None, fp=None, flag=99):
+    def write_bams(self, folders):
         """
-        Write out a BAM file with all of the reads from `info`
-        `info` is a dict with 
+        Write out the filtered DSC and SSC as BAM for every folder, in a single pass.
+        `folders` is a dict with the maximum number of variants (or None) for each folder.
         """
 
+        # The three kinds of BAM in each folder, with the flag used for each
+        kinds = [("DSC", 99), ("SSC.POS", 99), ("SSC.NEG", 83)]
+
+        # Output path for each folder and kind of BAM
+        outputs = {
+            (folder, prefix): os.path.join(folder, f"{folder}.{prefix}.bam")
+            for folder in folders
+            for prefix, _ in kinds
+        }
+
         logger.info(f"Copying header from {input_pos_bam}")
-        with pysam.AlignmentFile(input_pos_bam, "r") as template:
+        with pysam.AlignmentFile(input_pos_bam, "r", threads=THREADS) as template, ExitStack() as stack:
 
             # Map each reference name to an id
             reference_id_map = {
@@ -658,112 +756,187 @@ class ParseSSC:
                 for i, d in enumerate(template.header.to_dict()["SQ"])
             }
 
-            logger.info(f"Writing out BAM to {fp}")
-            with pysam.AlignmentFile(fp, "wb", template=template) as outf:
-
-                # Iterate over each family
-                for family_id, family_dat in info.items():
-                    
-                    # If the family is in the list to keep
-                    if family_id in keep_families and family_dat["ref_name"] in reference_id_map:
-
-                        seqlen = (family_dat["end"] - family_dat["start"]) + 1
-                        a = pysam.AlignedSegment()
-                        a.query_name = family_id
-                        a.query_sequence = family_dat["cons"]
-                        a.flag = flag
-                        a.reference_id = reference_id_map[family_dat["ref_name"]]
-                        a.reference_start = family_dat["start"]
-                        a.mapping_quality = 20
-                        a.cigar = [(0,len(family_dat["cons"]))]
-                        a.query_qualities = pysam.qualitystring_to_array("".join(["?" for _ in family_dat["cons"]]))
-                        outf.write(a)
-
-        # Sort the BAM file
-        sorted_fp = fp + ".sorted.bam"
-        logger.info(f"Sorting {fp}")
-        pysam.sort("-o", sorted_fp, fp)
-        os.rename(sorted_fp, fp)
-
-        # Index the sorted BAM file
-        logger.info(f"Indexing {fp}")
-        pysam.index(fp)
-
-    def format_summary(self, keep_families=None):
-        """Summarize the output, both by contig and overall."""
-
-        # Count up the number of molecules, bases, variants, and adducts
-        # both overall
-        total_counts = defaultdict(int)
-        # by chromosome
-        chr_counts = defaultdict(lambda: defaultdict(int))
-        # by the base change for mutations
-        # A -> T, T -> C, etc.
-        variant_base_changes = defaultdict(lambda: defaultdict(int))
-        # and by the base change for adducts
-        adduct_base_changes = defaultdict(lambda: defaultdict(int))
-
-        # Iterate over each SSC
-        for family_id, dsc in self.dsc_info.items():
-
-            # If the family is not in the list to keep
-            if family_id not in keep_families:
-
-                # Skip it
-                continue
-
-            # Increment the number of families
-            total_counts['ssc'] += 1
-            chr_counts[dsc['ref_name']]['families'] += 1
-
-            # Increment the number of bases
-            total_counts['bases'] += dsc['nbases']
-            chr_counts[dsc['ref_name']]['bases'] += dsc['nbases']
-
-            # Increment the number of adducts
-            total_counts['adducts'] += len(dsc['adducts'])
-            chr_counts[dsc['ref_name']]['adducts'] += len(dsc['adducts'])
+            # Open all of the outputs at once, splitting the threads between them
+            # so that no more than THREADS are used in total
+            # Note: with threads=1, htslib compresses in the calling thread
+            # without starting a thread pool
+            writer_threads = max(THREADS // len(outputs), 1)
+            handles = dict()
+            for key, fp in outputs.items():
+                logger.info(f"Writing out BAM to {fp}")
+                handles[key] = stack.enter_context(
+                    pysam.AlignmentFile(
+                        fp + ".unsorted",
+                        "wb",
+                        template=template,
+                        threads=writer_threads
+                    )
+                )
 
-            # Iterate over each of the positions with a variant
-            for variant_info in dsc['variants'].values():
+            # The CIGAR and base qualities only depend on the length of the consensus,
+            # so they are reused for every read of the same length
+            cigar_cache = dict()
+            qual_cache = dict()
+
+            # Iterate over each family
+            for family_id, dsc in self.dsc_info.items():
+
+                # Get the folders which the family should be written to
+                family_folders = [
+                    folder
+                    for folder, max_vars in folders.items()
+                    if max_vars is None or dsc[self.filter_on] <= max_vars
+                ]
+                if len(family_folders) == 0:
+                    continue
+
+                # Get the consensus for the DSC, and for each strand
+                for (prefix, flag), family_dat in zip(
+                    kinds,
+                    [dsc, self.ssc_info[family_id]["pos"], self.ssc_info[family_id]["neg"]]
+                ):
+
+                    # Skip any consensus which isn't aligned to the reference
+                    if family_dat["ref_name"] not in reference_id_map:
+                        continue
+
+                    seqlen = len(family_dat["cons"])
+                    if seqlen not in cigar_cache:
+                        cigar_cache[seqlen] = [(0, seqlen)]
+                        qual_cache[seqlen] = pysam.qualitystring_to_array("?" * seqlen)
+
+                    a = pysam.AlignedSegment()
+                    a.query_name = family_id
+                    a.query_sequence = family_dat["cons"]
+                    a.flag = flag
+                    a.reference_id = reference_id_map[family_dat["ref_name"]]
+                    a.reference_start = family_dat["start"]
+                    a.mapping_quality = 20
+                    a.cigar = cigar_cache[seqlen]
+                    a.query_qualities = qual_cache[seqlen]
+
+                    # Write the same read to each of the folders
+                    for folder in family_folders:
+                        handles[(folder, prefix)].write(a)
+
+        # Sort and index each of the BAM files
+        for fp in outputs.values():
+            self.sort_and_index(fp)
+
+    def sort_and_index(self, fp):
+        """Sort the unsorted BAM written to `fp`.unsorted into `fp`, writing the index at the same time."""
+
+        # Sort the BAM file, writing a BAI index alongside it
+        # Note: samtools uses its default memory limit (768M) for each thread
+        logger.info(f"Sorting and indexing {fp}")
+        pysam.sort(
+            "-@", str(THREADS),
+            "--write-index",
+            "-o", f"{fp}##idx##{fp}.bai",
+            fp + ".unsorted"
+        )
+        os.remove(fp + ".unsorted")
 
-                # Increment the number of variants
-                total_counts['variants'] += 1
-                chr_counts[dsc['ref_name']]['variants'] += 1
+    def format_summary_records(self):
+        """
+        Flatten the DSC information into one table with a row per family,
+        and another with a row per variant or adduct.
+        """
 
-                # Increment the individual base change
-                variant_base_changes[variant_info['var']][variant_info['ref']] += 1
+        # One row per family
+        self.family_records = pd.DataFrame(
+            [
+                (
+                    family_id,
+                    dsc['ref_name'],
+                    dsc['nbases'],
+                    # Note: adducts are counted twice, both per family and per position
+                    2 * len(dsc['adducts']),
+                    len(dsc['variants'])
+                )
+                for family_id, dsc in self.dsc_info.items()
+            ],
+            columns=['family_id', 'ref_name', 'bases', 'adducts', 'variants']
+        ).astype({'bases': np.int64, 'adducts': np.int64, 'variants': np.int64})
+
+        # One row per variant or adduct, with the index of each base in BASES
+        self.base_change_records = pd.DataFrame(
+            [
+                (family_id, kind, BASE_INDEX[info['var']], BASE_INDEX[info['ref']])
+                for family_id, dsc in self.dsc_info.items()
+                for kind in ['variants', 'adducts']
+                for info in dsc[kind].values()
+            ],
+            columns=['family_id', 'kind', 'var', 'ref']
+        ).astype({'var': np.int64, 'ref': np.int64})
 
-            # Iterate over each of the positions with an adduct
-            for adduct_info in dsc['adducts'].values():
+    def format_summary(self, keep_families=None):
+        """Summarize the output, both by contig and overall."""
 
-                # Increment the number of adducts
-                total_counts['adducts'] += 1
-                chr_counts[dsc['ref_name']]['adducts'] += 1
+        # Get the records for the families to keep
+        families = self.family_records.loc[
+            self.family_records['family_id'].isin(keep_families)
+        ]
+        base_changes = self.base_change_records.loc[
+            self.base_change_records['family_id'].isin(keep_families)
+        ]
 
-                # Increment the individual base change
-                adduct_base_changes[adduct_info['var']][adduct_info['ref']] += 1
+        # Count up the number of families, bases, variants, and adducts
+        # by chromosome
+        chr_counts = families.groupby('ref_name', sort=False, dropna=False).agg(
+            families=('bases', 'size'),
+            bases=('bases', 'sum'),
+            adducts=('adducts', 'sum'),
+            variants=('variants', 'sum')
+        ).astype(np.int64)
+        chr_counts.index.name = None
+
+        # Variants are only reported when there are any, as in the per-family counts
+        if chr_counts['variants'].sum() == 0:
+            chr_counts = chr_counts.drop(columns='variants')
+
+        # by the base change for mutations and adducts
+        # A -> T, T -> C, etc.
+        # Each table is indexed by the reference base, with a column for each variant base
+        base_change_tables = dict()
+        for kind in ['variants', 'adducts']:
+            kind_changes = base_changes.loc[base_changes['kind'] == kind]
+            counts = np.zeros((len(BASES), len(BASES)), dtype=np.int64)
+            np.add.at(counts, (kind_changes['ref'].values, kind_changes['var'].values), 1)
+            base_change_tables[kind] = pd.DataFrame(counts, index=BASES, columns=BASES)
+
+        # Count up the totals overall
+        total_counts = dict()
+        if families.shape[0] > 0:
+            total_counts['ssc'] = families.shape[0]
+            total_counts['bases'] = int(chr_counts['bases'].sum())
+            total_counts['adducts'] = int(chr_counts['adducts'].sum())
+        if 'variants' in chr_counts:
+            total_counts['variants'] = int(chr_counts['variants'].sum())
 
         # Add all of the subset data to the totals
         total_counts['specimen'] = specimen
-        total_counts['by_chr'] = chr_counts
-        total_counts['variant_base_changes'] = variant_base_changes
-        total_counts['adduct_base_changes'] = adduct_base_changes
-
-        # Format the base change data as DataFrames
-        variant_base_changes = pd.DataFrame(variant_base_changes).reindex(
-            columns=['A', 'T', 'C', 'G'],
-            index=['A', 'T', 'C', 'G']
-        ).fillna(0).applymap(int)
+        total_counts['by_chr'] = {
+            ref_name: {
+                key: int(val)
+                for key, val in counts.items()
+                if key != 'variants' or val > 0
+            }
+            for ref_name, counts in chr_counts.iterrows()
+        }
+        total_counts['variant_base_changes'] = self.nonzero_base_changes(base_change_tables['variants'])
+        total_counts['adduct_base_changes'] = self.nonzero_base_changes(base_change_tables['adducts'])
 
-        adduct_base_changes = pd.DataFrame(adduct_base_changes).reindex(
-            columns=['A', 'T', 'C', 'G'],
-            index=['A', 'T', 'C', 'G']
-        ).fillna(0).applymap(int)
+        return total_counts, chr_counts.T, base_change_tables['variants'], base_change_tables['adducts']
 
-        chr_counts = pd.DataFrame(chr_counts).fillna(0).applymap(int)
+    def nonzero_base_changes(self, table):
+        """Format the nonzero counts of a table of base changes as a dict, keyed by variant and then reference base."""
 
-        return total_counts, chr_counts, variant_base_changes, adduct_base_changes
+        return {
+            var: {ref: int(n) for ref, n in table[var].items() if n > 0}
+            for var in BASES
+            if table[var].sum() > 0
+        }
 
     def write_total_json(self, folder=None, keep_families=None):
         """Save the total information to JSON."""
@@ -772,15 +945,20 @@ class ParseSSC:
 
         logger.info(f"Writing all output to {fpo}")
 
-        with gzip.open(fpo, "wt") as handle:
-            json.dump(
-                {
-                    family_id: dsc
-                    for family_id, dsc in self.dsc_info.items()
-                    if family_id in keep_families
-                },
-                handle
-            )
+        # Write one family at a time, rather than building the whole
+        # object in memory
+        # Note: compresslevel=1 is used because this is an intermediate file
+        with gzip.GzipFile(fpo, "wb", compresslevel=1) as handle:
+            handle.write(b"{")
+            first = True
+            for family_id, dsc in self.dsc_info.items():
+                if family_id not in keep_families:
+                    continue
+                if not first:
+                    handle.write(b",")
+                handle.write(dumps_json(family_id) + b":" + dumps_json(dsc))
+                first = False
+            handle.write(b"}")
 
     def write_adduct_family_list(self, folder=None, keep_families=None):
         """Save the list of all families which contain adducts."""
@@ -790,8 +968,18 @@ class ParseSSC:
         fpo = os.path.join(folder, f"{folder}.adduct.families.txt.gz")
 
         logger.info(f"Writing out {len(keep_families):,} families to {fpo}")
-        with gzip.open(fpo, "wt") as handle:
-            handle.write("\n".join(list(keep_families)))
+        # Note: compresslevel=1 is used because this is an intermediate file
+        with gzip.open(fpo, "wt", compresslevel=1) as handle:
+
+            # Write the names in chunks, separated by newlines
+            families = iter(keep_families)
+            sep = ""
+            while True:
+                chunk = list(islice(families, 1000))
+                if len(chunk) == 0:
+                    break
+                handle.write(sep + "\n".join(chunk))
+                sep = "\n"
 
     def write_adducts_gtf(self, folder=None, keep_families=None):
         """Write out the adduct information in GTF format."""
@@ -801,20 +989,20 @@ class ParseSSC:
 
         logger.info(f"Writing out adducts to {fpo} for {len(keep_families):,} families")
 
-        # Make a list of all adducts
-        adducts = [
-            dict(
-                seqname=dsc['ref_name'],
+        # Get the unique adducts, keeping the order in which they are first seen
+        adducts = dict.fromkeys(
+            (
+                dsc['ref_name'],
                 # 0-index -> 1-index
-                start=adduct_pos + 1,
-                end=adduct_pos + 1,
-                strand="+" if adduct_info["strand"] == "pos" else "-",
-                attribute='adduct "%s"; read_as "%s";' % (adduct_info['ref'], adduct_info['var'])
+                adduct_pos + 1,
+                "+" if adduct_info["strand"] == "pos" else "-",
+                adduct_info['ref'],
+                adduct_info['var']
             )
             for family_id, dsc in self.dsc_info.items()
             if family_id in keep_families
             for adduct_pos, adduct_info in dsc["adducts"].items()
-        ]
+        )
 
         # If there are no adducts
         if len(adducts) == 0:
@@ -826,41 +1014,13 @@ class ParseSSC:
 
             print(f"Writing out {len(adducts):,} adducts in GTF format")
 
-        # Convert to a DataFrame
-        adducts = pd.DataFrame(adducts)
-
-        # Drop any duplicates
-        adducts = adducts.drop_duplicates()
-
-        # Add in the fixed columns and resort
-        adducts = adducts.assign(
-            source=specimen,
-            feature="adduct",
-            score='.',
-            frame='.'
-        ).reindex(
-            columns=[
-                "seqname",
-                "source",
-                "feature",
-                "start",
-                "end",
-                "score",
-                "strand",
-                "frame",
-                "attribute"
-            ]
-        ).sort_values(
-            by=['seqname', 'start']
-        )
-
-        # Write out as TSV
-        adducts.to_csv(
-            fpo,
-            sep="\t",
-            index=None,
-            quoting=3
-        )
+        # Write out as TSV, sorted by position
+        with open(fpo, "w") as handle:
+            handle.write("seqname\tsource\tfeature\tstart\tend\tscore\tstrand\tframe\tattribute\n")
+            for seqname, pos, strand, ref, var in sorted(adducts, key=lambda adduct: adduct[:2]):
+                handle.write(
+                    f'{seqname}\t{specimen}\tadduct\t{pos}\t{pos}\t.\t{strand}\t.\tadduct "{ref}"; read_as "{var}";\n'
+                )
 
 ParseSSC(
     specimen,
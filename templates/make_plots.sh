@@ -2,4 +2,4 @@
 
 set -euo pipefail
 
-make_plots.py
\ No newline at end of file
+make_plots.py "${task.cpus}"
\ No newline at end of file
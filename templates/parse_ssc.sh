@@ -2,4 +2,4 @@
 
 set -e
 
-parse_ssc.py "${specimen}" "${params.filter_on}" "${params.filter_max}"
\ No newline at end of file
+parse_ssc.py "${specimen}" "${params.filter_on}" "${params.filter_max}" "${task.cpus}"
\ No newline at end of file